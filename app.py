@@ -1,16 +1,31 @@
 
 
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, g, stream_with_context, has_app_context
 from flask_cors import CORS
 import pymysql
 from datetime import datetime, date, time
 import io
+import json
+import cProfile
+import hmac
+import threading
+import uuid
+from contextlib import contextmanager
+from time import perf_counter, sleep, time_ns
 import pandas as pd
 from decimal import Decimal
-from fuzzywuzzy import fuzz 
+from fuzzywuzzy import fuzz, process
 from werkzeug.utils import secure_filename
 import os
+import sys
+import subprocess
+try:
+    import fcntl
+except ImportError:
+    # Windows: the builder runs without the single-builder lock
+    fcntl = None
+from catalogue_snapshot import CatalogueSnapshot, write_catalogue_snapshot
 
 app = Flask(__name__)
 CORS(app)
@@ -20,6 +35,35 @@ app.config['MYSQL_USER'] = 'root'
 app.config['MYSQL_PASSWORD'] = ''
 app.config['MYSQL_DB'] = 'medingen'
 
+# Per-request profiling is only enabled when an admin token is configured
+app.config['PROFILE_ADMIN_TOKEN'] = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+
+# cProfile cannot run two profilers at once, so only one request is profiled at a time
+profile_lock = threading.Lock()
+
+# Upper bound on fuzzy suggestions returned per unmatched upload row
+MAX_FUZZY_TOP_N = 10
+# Fuzzy scoring only runs over the catalogue names sharing the most trigrams with the row
+MAX_FUZZY_CANDIDATES = 200
+
+# Matching reads the catalogue from a shared memory-mapped snapshot instead of per-request DictCursor rows
+app.config['CATALOGUE_SNAPSHOT_PATH'] = os.environ.get('CATALOGUE_SNAPSHOT_PATH', 'catalogue.snapshot')
+# How often the builder checks for stale marks, and the oldest snapshot workers will serve. The
+# builder refreshes at half that age, which also picks up edits made outside this app.
+app.config['CATALOGUE_POLL_SECONDS'] = int(os.environ.get('CATALOGUE_POLL_SECONDS', 5))
+app.config['CATALOGUE_MAX_AGE_SECONDS'] = int(os.environ.get('CATALOGUE_MAX_AGE_SECONDS', 300))
+# How long a match request waits for a usable snapshot before giving up
+app.config['CATALOGUE_WAIT_SECONDS'] = int(os.environ.get('CATALOGUE_WAIT_SECONDS', 30))
+# Set to 'external' when the builder runs as its own service (python app.py --catalogue-builder)
+app.config['CATALOGUE_BUILDER'] = os.environ.get('CATALOGUE_BUILDER', 'auto')
+
+catalogue_lock = threading.Lock()
+catalogue_snapshot = None
+catalogue_snapshot_key = None
+catalogue_builder = None
+catalogue_builder_checked = None
+
 def get_mysql_connection():
     return pymysql.connect(
         host=app.config['MYSQL_HOST'],
@@ -43,6 +87,330 @@ def serialize_product(product):
         return None
     return {key: serialize_value(value) for key, value in product.items()}
 
+def find_excel_column(columns, *names):
+    # Case-insensitive header lookup, returning the sheet's own spelling of the first name present
+    by_upper = {col.upper(): col for col in columns}
+    for name in names:
+        if name in by_upper:
+            return by_upper[name]
+    return None
+
+def find_brand_column(columns):
+    # Prefer an explicit brand header so a GENERIC NAME column placed first is never taken as the brand
+    brand_col = find_excel_column(columns, 'BRAND NAME', 'BRAND', 'PRODUCT NAME', 'NAME')
+    if brand_col:
+        return brand_col
+    for col in columns:
+        if 'BRAND' in col.upper():
+            return col
+    for col in columns:
+        if 'NAME' in col.upper() and 'GENERIC' not in col.upper():
+            return col
+    return None
+
+def excel_cell(row, col):
+    if not col or pd.isna(row[col]):
+        return ''
+    return str(row[col]).strip()
+
+def parse_excel_products(file):
+    excel_file = pd.ExcelFile(file)
+    all_products = []
+    
+    for sheet_name in excel_file.sheet_names:
+        df = pd.read_excel(excel_file, sheet_name=sheet_name)
+        
+        df.columns = [str(col).strip() for col in df.columns]
+        
+        brand_col = find_brand_column(df.columns)
+        if not brand_col:
+            continue
+        
+        generic_col = find_excel_column(df.columns, 'GENERIC NAME', 'GENERIC')
+        packing_col = find_excel_column(df.columns, 'PACKING')
+        manufacturer_col = find_excel_column(df.columns, 'MANUFACTURER', 'MFR')
+        billing_rate_col = find_excel_column(df.columns, 'BILLING RATE')
+        mrp_col = find_excel_column(df.columns, 'MRP')
+        qty_required_col = find_excel_column(df.columns, 'QTY REQUIRED')
+        
+        for idx, row in df.iterrows():
+            product_name = excel_cell(row, brand_col)
+            if product_name and product_name.lower() != 'nan':
+                product_data = {
+                    'sheet_name': sheet_name,
+                    'row_number': idx + 2, 
+                    'brand_name': product_name,
+                    'generic_name': excel_cell(row, generic_col),
+                    'packing': excel_cell(row, packing_col),
+                    'manufacturer': excel_cell(row, manufacturer_col),
+                    'billing_rate': excel_cell(row, billing_rate_col),
+                    'mrp': excel_cell(row, mrp_col),
+                    'qty_required': excel_cell(row, qty_required_col)
+                }
+                all_products.append(product_data)
+    
+    return all_products, len(excel_file.sheet_names)
+
+def find_stock_match(lookup_full, lookup_name_only, brand_name, generic_name):
+    brand_lower = brand_name.lower()
+    generic_lower = generic_name.lower()
+    
+    match = None
+    
+    # Tier 1: Match against (Brand, Composition) or (RC Brand, Composition)
+    if generic_lower:
+        match = lookup_full.get((brand_lower, generic_lower))
+    
+    # Tier 2: Match against Brand Name only or RC Name only
+    if not match:
+        match = lookup_name_only.get(brand_lower)
+    
+    return match
+
+def build_catalogue_snapshot():
+    path = app.config['CATALOGUE_SNAPSHOT_PATH']
+    started = time_ns()
+    
+    connection = get_mysql_connection()
+    try:
+        # Unbuffered cursor, so rows stream into the writer instead of being fetched all at once
+        with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute("SELECT product_id, name, composition, rc_pharam_product_name, inStock FROM products")
+            write_catalogue_snapshot(path, cursor)
+    finally:
+        connection.close()
+    
+    # Stamp with the time the read started, so writes that land during the build still count as stale
+    os.utime(path, ns=(started, started))
+
+def catalogue_age_seconds():
+    try:
+        return (time_ns() - os.stat(app.config['CATALOGUE_SNAPSHOT_PATH']).st_mtime_ns) / 1_000_000_000
+    except OSError:
+        return None
+
+def catalogue_needs_rebuild():
+    path = app.config['CATALOGUE_SNAPSHOT_PATH']
+    stale_path = path + '.stale'
+    
+    try:
+        stat = os.stat(path)
+        CatalogueSnapshot(path)
+    except Exception:
+        # Missing, truncated or written by an older format version
+        return True
+    
+    if os.path.exists(stale_path) and os.stat(stale_path).st_mtime_ns >= stat.st_mtime_ns:
+        return True
+    return catalogue_age_seconds() >= app.config['CATALOGUE_MAX_AGE_SECONDS'] / 2
+
+def run_catalogue_builder():
+    # Runs in its own process (python app.py --catalogue-builder), so building never holds
+    # the GIL of a request-serving worker. Only one builder runs per snapshot path.
+    # Kept open for the life of the process, which holds the lock
+    lock_file = open(app.config['CATALOGUE_SNAPSHOT_PATH'] + '.lock', 'a')
+    if fcntl:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return
+    
+    # Always rebuild on taking over, so a snapshot left by a previous run is refreshed first
+    rebuild = True
+    while True:
+        if rebuild or catalogue_needs_rebuild():
+            try:
+                build_catalogue_snapshot()
+            except Exception:
+                app.logger.exception('Catalogue snapshot build failed')
+        rebuild = False
+        sleep(app.config['CATALOGUE_POLL_SECONDS'])
+
+def start_catalogue_builder():
+    # Spawns a builder process unless this one's is still running or the snapshot is being kept
+    # fresh by another builder. A spare builder exits straight away if the lock is already held.
+    global catalogue_builder, catalogue_builder_checked
+    if app.config['CATALOGUE_BUILDER'] == 'external':
+        return
+    
+    with catalogue_lock:
+        if catalogue_builder is not None and catalogue_builder.poll() is None:
+            return
+        if catalogue_builder_checked is not None:
+            if perf_counter() - catalogue_builder_checked < app.config['CATALOGUE_POLL_SECONDS']:
+                return
+            age = catalogue_age_seconds()
+            if age is not None and age < app.config['CATALOGUE_MAX_AGE_SECONDS'] * 3 / 4:
+                catalogue_builder_checked = perf_counter()
+                return
+        
+        catalogue_builder_checked = perf_counter()
+        catalogue_builder = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--catalogue-builder'])
+
+def mark_catalogue_stale():
+    # Touch a marker file; the builder picks it up on its next poll. Called after the write has
+    # committed, so a failure here is logged rather than turned into an error response.
+    stale_path = app.config['CATALOGUE_SNAPSHOT_PATH'] + '.stale'
+    try:
+        with open(stale_path, 'a'):
+            pass
+        os.utime(stale_path)
+    except OSError:
+        app.logger.exception('Could not mark catalogue snapshot stale')
+
+def map_catalogue_snapshot():
+    global catalogue_snapshot, catalogue_snapshot_key
+    path = app.config['CATALOGUE_SNAPSHOT_PATH']
+    
+    with catalogue_lock:
+        try:
+            stat = os.stat(path)
+            key = (stat.st_ino, stat.st_mtime_ns)
+            # A rebuilt file has a new inode; in-flight requests keep the old mapping
+            if key != catalogue_snapshot_key:
+                catalogue_snapshot = CatalogueSnapshot(path)
+                catalogue_snapshot_key = key
+        except FileNotFoundError:
+            pass
+        except Exception:
+            app.logger.exception('Could not map catalogue snapshot')
+        
+        # Never serve a snapshot older than the max age, e.g. one left by an earlier run
+        if catalogue_snapshot is None:
+            return None
+        if time_ns() - catalogue_snapshot_key[1] >= app.config['CATALOGUE_MAX_AGE_SECONDS'] * 1_000_000_000:
+            return None
+        return catalogue_snapshot
+
+def get_catalogue_snapshot():
+    # Request handlers only ever map the current file; building is left to the catalogue builder
+    start_catalogue_builder()
+    deadline = perf_counter() + app.config['CATALOGUE_WAIT_SECONDS']
+    
+    while True:
+        snapshot = map_catalogue_snapshot()
+        if snapshot is not None:
+            return snapshot
+        if perf_counter() >= deadline:
+            raise RuntimeError('Catalogue snapshot is not available yet, please retry shortly')
+        sleep(0.5)
+
+def is_profile_admin():
+    token = app.config['PROFILE_ADMIN_TOKEN']
+    # Compare bytes: compare_digest rejects str arguments with non-ASCII characters
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), token.encode())
+
+def profiling_requested():
+    flag = request.headers.get('X-Profile', request.args.get('profile', ''))
+    return flag.lower() in ('1', 'true', 'yes') and is_profile_admin()
+
+@app.before_request
+def start_profiling():
+    g.profiler = None
+    g.profile_timings = None
+    
+    if not profiling_requested() or not profile_lock.acquire(blocking=False):
+        return
+    
+    g.profile_started = perf_counter()
+    g.profile_timings = {}
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+@contextmanager
+def profile_section(name):
+    # Records wall-clock time for one stage of the request; no-op unless profiling
+    timings = g.get('profile_timings') if has_app_context() else None
+    if timings is None:
+        yield
+        return
+    
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + (perf_counter() - started) * 1000
+
+def stop_profiling():
+    profiler = g.get('profiler')
+    if not profiler:
+        return None
+    profiler.disable()
+    g.profiler = None
+    profile_lock.release()
+    return profiler
+
+def write_profile(profiler, profile):
+    # profile holds the request details captured in after_request, so this also works once
+    # the request context is gone
+    total_ms = (perf_counter() - profile['started']) * 1000
+    profile_dir = app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    
+    profiler.dump_stats(os.path.join(profile_dir, f"{profile['profile_id']}.pstats"))
+    with open(os.path.join(profile_dir, f"{profile['profile_id']}.json"), 'w') as f:
+        json.dump({
+            'profile_id': profile['profile_id'],
+            'method': profile['method'],
+            'path': profile['path'],
+            'status': profile['status'],
+            # False when a streamed body was sent after profiling stopped and is not included
+            'complete': profile['complete'],
+            'total_ms': round(total_ms, 2),
+            'sections_ms': {name: round(ms, 2) for name, ms in profile['timings'].items()}
+        }, f, indent=2)
+    
+    return total_ms
+
+@app.after_request
+def finish_profiling(response):
+    profiler = g.get('profiler')
+    if not profiler:
+        return response
+    
+    profile = {
+        'profile_id': f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}",
+        'method': request.method,
+        'path': request.full_path,
+        'status': response.status_code,
+        'complete': not response.is_streamed,
+        'started': g.profile_started,
+        'timings': g.profile_timings
+    }
+    response.headers['X-Profile-Id'] = profile['profile_id']
+    
+    # Views that stream through stream_with_context keep profiling until the WSGI server closes
+    # the response, i.e. once the body is exhausted or the client goes away. This does not
+    # depend on when Flask pops the request context.
+    if response.is_streamed and g.get('profile_stream'):
+        g.profiler = None
+        profile['complete'] = True
+        
+        def finish_streamed_profile():
+            profiler.disable()
+            profile_lock.release()
+            try:
+                write_profile(profiler, profile)
+            except Exception:
+                app.logger.exception('Failed to write profile %s', profile['profile_id'])
+        
+        response.call_on_close(finish_streamed_profile)
+        return response
+    
+    stop_profiling()
+    total_ms = write_profile(profiler, profile)
+    
+    timings = [f'{name};dur={ms:.1f}' for name, ms in profile['timings'].items()]
+    timings.append(f'total;dur={total_ms:.1f}')
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+@app.teardown_request
+def release_profiler(exc):
+    # Unhandled errors skip after_request; make sure the profiler is not left running
+    stop_profiling()
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     try:
@@ -167,6 +535,7 @@ def create_product():
             product_id = cursor.lastrowid
         
         connection.close()
+        mark_catalogue_stale()
         
         return jsonify({
             'success': True,
@@ -254,6 +623,7 @@ def update_product(product_id):
             affected_rows = cursor.rowcount
         
         connection.close()
+        mark_catalogue_stale()
         
         if affected_rows == 0:
             return jsonify({'success': False, 'error': 'Product not found'}), 404
@@ -276,6 +646,7 @@ def delete_product(product_id):
             affected_rows = cursor.rowcount
         
         connection.close()
+        mark_catalogue_stale()
         
         if affected_rows == 0:
             return jsonify({'success': False, 'error': 'Product not found'}), 404
@@ -359,45 +730,17 @@ def upload_excel():
         if not file.filename.endswith(('.xlsx', '.xls')):
             return jsonify({'success': False, 'error': 'Invalid file type. Please upload Excel file'}), 400
         
-        excel_file = pd.ExcelFile(file)
-        all_products = []
-        
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(excel_file, sheet_name=sheet_name)
-            
-            df.columns = df.columns.str.strip()
-            
-            brand_col = None
-            for col in df.columns:
-                if 'BRAND' in col.upper() or 'NAME' in col.upper():
-                    brand_col = col
-                    break
-            
-            if not brand_col:
-                continue
-            
-            for idx, row in df.iterrows():
-                product_name = str(row[brand_col]).strip() if pd.notna(row[brand_col]) else ''
-                if product_name and product_name.lower() != 'nan':
-                    product_data = {
-                        'sheet_name': sheet_name,
-                        'row_number': idx + 2, 
-                        'brand_name': product_name,
-                        'generic_name': str(row.get('GENERIC NAME', '')).strip() if 'GENERIC NAME' in df.columns else '',
-                        'packing': str(row.get('PACKING', '')).strip() if 'PACKING' in df.columns else '',
-                        'manufacturer': str(row.get('MFR', '')).strip() if 'MFR' in df.columns else '',
-                        'billing_rate': str(row.get('BILLING RATE', '')).strip() if 'BILLING RATE' in df.columns else '',
-                        'mrp': str(row.get('MRP', '')).strip() if 'MRP' in df.columns else '',
-                        'qty_required': str(row.get('QTY REQUIRED', '')).strip() if 'QTY REQUIRED' in df.columns else ''
-                    }
-                    all_products.append(product_data)
+        with profile_section('parse_excel'):
+            all_products, sheets_processed = parse_excel_products(file)
         
-        return jsonify({
-            'success': True,
-            'data': all_products,
-            'count': len(all_products),
-            'sheets_processed': len(excel_file.sheet_names)
-        }), 200
+        with profile_section('serialize'):
+            response = jsonify({
+                'success': True,
+                'data': all_products,
+                'count': len(all_products),
+                'sheets_processed': sheets_processed
+            })
+        return response, 200
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -438,45 +781,50 @@ def find_matches():
                 WHERE {" OR ".join(conditions)}
                 LIMIT 200
             """
-            cursor.execute(query, params)
-            db_results = cursor.fetchall()
+            with profile_section('db_fetch'):
+                cursor.execute(query, params)
+                db_results = cursor.fetchall()
             
-            for p in db_results:
-                db_composition = str(p.get('composition') or '').strip()
-                db_name = str(p.get('name') or '').strip()
-                db_rc_name = str(p.get('rc_pharam_product_name') or '').strip()
-                db_salt = str(p.get('salt_name') or '').strip()
+            with profile_section('ranking'):
+                for p in db_results:
+                    db_composition = str(p.get('composition') or '').strip()
+                    db_name = str(p.get('name') or '').strip()
+                    db_rc_name = str(p.get('rc_pharam_product_name') or '').strip()
+                    db_salt = str(p.get('salt_name') or '').strip()
                 
-                # Restore match_count calculation
-                match_count = 0
-                searchable_text = f"{db_name} {db_rc_name} {db_composition} {db_salt}".lower()
-                for word in search_words:
-                    if word.lower() in searchable_text:
-                        match_count += 1
+                    # Restore match_count calculation
+                    match_count = 0
+                    searchable_text = f"{db_name} {db_rc_name} {db_composition} {db_salt}".lower()
+                    for word in search_words:
+                        if word.lower() in searchable_text:
+                            match_count += 1
                 
-                matches.append({
-                    'product_id': p['product_id'],
-                    'name': p['name'],
-                    'rc_pharam_product_name': p['rc_pharam_product_name'],
-                    'composition': p['composition'],
-                    'salt_name': p['salt_name'],
-                    'manufacturer': p['manufacturer'],
-                    'price': float(p['product_pricing_new']) if p['product_pricing_new'] else None,
-                    'match_score': match_count,
-                    'match_type': "Match",
-                    'inStock': bool(p.get('inStock', False))
-                })
+                    matches.append({
+                        'product_id': p['product_id'],
+                        'name': p['name'],
+                        'rc_pharam_product_name': p['rc_pharam_product_name'],
+                        'composition': p['composition'],
+                        'salt_name': p['salt_name'],
+                        'manufacturer': p['manufacturer'],
+                        'price': float(p['product_pricing_new']) if p['product_pricing_new'] else None,
+                        'match_score': match_count,
+                        'match_type': "Match",
+                        'inStock': bool(p.get('inStock', False))
+                    })
         
         connection.close()
         
         # Sort by match count (descending), then name
-        matches.sort(key=lambda x: (-x['match_score'], x['name']))
+        with profile_section('ranking'):
+            matches.sort(key=lambda x: (-x['match_score'], x['name']))
         
-        return jsonify({
-            'success': True,
-            'data': matches,
-            'count': len(matches)
-        }), 200
+        with profile_section('serialize'):
+            response = jsonify({
+                'success': True,
+                'data': matches,
+                'count': len(matches)
+            })
+        return response, 200
         
     except Exception as e:
         if 'connection' in locals() and connection:
@@ -512,6 +860,7 @@ def approve_match():
                 affected_rows = cursor.rowcount
 
             connection.close()
+            mark_catalogue_stale()
 
             if affected_rows == 0:
                 return jsonify({'success': False, 'error': 'Product not found'}), 200
@@ -565,6 +914,7 @@ def approve_match():
                 new_product_id = cursor.lastrowid
 
             connection.close()
+            mark_catalogue_stale()
 
             return jsonify({
                 'success': True,
@@ -599,6 +949,7 @@ def unmatch_product():
             connection.commit()
             
         connection.close()
+        mark_catalogue_stale()
         return jsonify({'success': True, 'message': 'Product unmatched successfully'}), 200
         
     except Exception as e:
@@ -616,97 +967,197 @@ def match_stock():
         if not new_products:
             return jsonify({'success': False, 'error': 'No products provided'}), 400
         
-        connection = get_mysql_connection()
+        with profile_section('catalogue'):
+            snapshot = get_catalogue_snapshot()
         
-        # Optimized: Fetch all relevant DB products once for in-memory matching
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT product_id, name, composition, rc_pharam_product_name, inStock FROM products")
-            db_all = cursor.fetchall()
-        
-        # Create lookup dictionaries for fast access
-        # Primary lookup: (brand_name, composition)
-        # Secondary lookup: (brand_name) - fallback
-        lookup_full = {}
-        lookup_name_only = {}
-        
-        for p in db_all:
-            name_lower = str(p['name'] or '').strip().lower()
-            rc_name_lower = str(p['rc_pharam_product_name'] or '').strip().lower()
-            comp_lower = str(p['composition'] or '').strip().lower()
-            
-            # Add to full lookup (both name and rc_name)
-            if comp_lower:
-                if name_lower: lookup_full[(name_lower, comp_lower)] = p
-                if rc_name_lower: lookup_full[(rc_name_lower, comp_lower)] = p
-            
-            # Add to name-only lookup (both name and rc_name)
-            if name_lower and name_lower not in lookup_name_only:
-                lookup_name_only[name_lower] = p
-            if rc_name_lower and rc_name_lower not in lookup_name_only:
-                lookup_name_only[rc_name_lower] = p
-        
-        matched_products = []
-        unmatched_products = []
-        
-        for new_product in new_products:
-            brand_name = str(new_product.get('brand_name', '')).strip()
-            generic_name = str(new_product.get('generic_name', '')).strip()
+        with profile_section('matching'):
+            matched_products = []
+            unmatched_products = []
+        
+            for new_product in new_products:
+                brand_name = str(new_product.get('brand_name', '')).strip()
+                generic_name = str(new_product.get('generic_name', '')).strip()
             
-            if not brand_name:
-                continue
+                if not brand_name:
+                    continue
             
-            brand_lower = brand_name.lower()
-            generic_lower = generic_name.lower()
+                match = find_stock_match(snapshot.lookup_full, snapshot.lookup_name_only, brand_name, generic_name)
             
-            match = None
+                if match:
+                    matched_products.append({
+                        'product_id': match['product_id'],
+                        'name': match['name'],
+                        'composition': match['composition'],
+                        'rc_pharam_product_name': match['rc_pharam_product_name'],
+                        'inStock': bool(match['inStock']),
+                        'matched_brand': brand_name,
+                        'matched_generic': generic_name
+                    })
+                else:
+                    unmatched_products.append({
+                        'brand_name': brand_name,
+                        'generic_name': generic_name
+                    })
+        
+        with profile_section('serialize'):
+            response = jsonify({
+                'success': True,
+                'message': f'Auto-detected {len(matched_products)} matches out of {len(new_products)}',
+                'matched_count': len(matched_products),
+                'unmatched_count': len(unmatched_products),
+                'matched_products': matched_products
+            })
+        return response, 200
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/products/upload-and-match', methods=['POST'])
+def upload_and_match():
+    try:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'success': False, 'error': 'No file selected'}), 400
+        
+        if not file.filename.endswith(('.xlsx', '.xls')):
+            return jsonify({'success': False, 'error': 'Invalid file type. Please upload Excel file'}), 400
+        
+        fuzzy = request.form.get('fuzzy', 'false').lower() in ('1', 'true', 'yes')
+        top_n = min(max(request.form.get('top_n', 5, type=int), 1), MAX_FUZZY_TOP_N)
+        
+        with profile_section('parse_excel'):
+            all_products, sheets_processed = parse_excel_products(file)
+        
+        # The stream keeps this snapshot's mapping alive even if a refresh replaces it meanwhile
+        with profile_section('catalogue'):
+            snapshot = get_catalogue_snapshot()
+        
+        def generate():
+            matched_count = 0
+            unmatched_count = 0
             
-            # Tier 1: Match against (Brand, Composition) or (RC Brand, Composition)
-            if generic_lower:
-                match = lookup_full.get((brand_lower, generic_lower))
+            yield json.dumps({
+                'type': 'start',
+                'count': len(all_products),
+                'sheets_processed': sheets_processed
+            }) + '\n'
             
-            # Tier 2: Match against Brand Name only or RC Name only
-            if not match:
-                match = lookup_name_only.get(brand_lower)
+            try:
+                for row_id, product in enumerate(all_products):
+                    with profile_section('matching'):
+                        match = find_stock_match(snapshot.lookup_full, snapshot.lookup_name_only, product['brand_name'], product['generic_name'])
+                    
+                    if match:
+                        matched_count += 1
+                        with profile_section('serialize'):
+                            line = json.dumps({
+                                'type': 'matched',
+                                'id': row_id,
+                                'product': product,
+                                'match': {
+                                    'product_id': match['product_id'],
+                                    'name': match['name'],
+                                    'composition': match['composition'],
+                                    'rc_pharam_product_name': match['rc_pharam_product_name'],
+                                    'inStock': bool(match['inStock'])
+                                }
+                            }) + '\n'
+                        yield line
+                        continue
+                    
+                    unmatched_count += 1
+                    candidates = []
+                    if fuzzy:
+                        with profile_section('fuzzy'):
+                            fuzzy_choices = snapshot.fuzzy_candidates(product['brand_name'], MAX_FUZZY_CANDIDATES)
+                            for _, score, i in process.extract(product['brand_name'], fuzzy_choices, scorer=fuzz.token_sort_ratio, limit=top_n):
+                                p = snapshot.row(i)
+                                candidates.append({
+                                    'product_id': p['product_id'],
+                                    'name': p['name'],
+                                    'composition': p['composition'],
+                                    'rc_pharam_product_name': p['rc_pharam_product_name'],
+                                    'inStock': bool(p['inStock']),
+                                    'match_score': score,
+                                    'match_type': 'Fuzzy'
+                                })
+                    
+                    with profile_section('serialize'):
+                        line = json.dumps({
+                            'type': 'unmatched',
+                            'id': row_id,
+                            'product': product,
+                            'candidates': candidates
+                        }) + '\n'
+                    yield line
+            except Exception as e:
+                yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+                return
             
-            if match:
-                matched_products.append({
-                    'product_id': match['product_id'],
-                    'name': match['name'],
-                    'composition': match['composition'],
-                    'rc_pharam_product_name': match['rc_pharam_product_name'],
-                    'inStock': bool(match['inStock']),
-                    'matched_brand': brand_name,
-                    'matched_generic': generic_name
-                })
-            else:
-                unmatched_products.append({
-                    'brand_name': brand_name,
-                    'generic_name': generic_name
-                })
+            yield json.dumps({
+                'type': 'done',
+                'matched_count': matched_count,
+                'unmatched_count': unmatched_count
+            }) + '\n'
         
-        connection.close()
+        # Keep the request context (and any active profiler) alive while the body streams
+        g.profile_stream = True
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
         
-        return jsonify({
-            'success': True,
-            'message': f'Auto-detected {len(matched_products)} matches out of {len(new_products)}',
-            'matched_count': len(matched_products),
-            'unmatched_count': len(unmatched_products),
-            'matched_products': matched_products
-        }), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    try:
+        if not is_profile_admin():
+            return jsonify({'success': False, 'error': 'Admin token required'}), 403
+        
+        fmt = request.args.get('format', 'pstats')
+        if fmt not in ('pstats', 'json'):
+            return jsonify({'success': False, 'error': 'format must be pstats or json'}), 400
         
+        filename = secure_filename(f'{profile_id}.{fmt}')
+        path = os.path.abspath(os.path.join(app.config['PROFILE_DIR'], filename))
+        if not os.path.exists(path):
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        
+        return send_file(
+            path,
+            mimetype='application/json' if fmt == 'json' else 'application/octet-stream',
+            as_attachment=True,
+            download_name=filename
+        )
     except Exception as e:
-        if 'connection' in locals() and connection:
-            connection.close()
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# Load at startup: spawn the builder as soon as the app is imported, unless this process is a builder
+if '--catalogue-builder' not in sys.argv and '--build-catalogue' not in sys.argv:
+    start_catalogue_builder()
 
 if __name__ == '__main__':
+    if '--catalogue-builder' in sys.argv:
+        run_catalogue_builder()
+        sys.exit(0)
+    
     print("=" * 50)
     print("Product Management API Server")
     print("=" * 50)
     print(f"Database: {app.config['MYSQL_DB']}")
     print(f"Host: {app.config['MYSQL_HOST']}")
+    
+    # One-off build for deploy steps or cron, without starting the server
+    if '--build-catalogue' in sys.argv:
+        build_catalogue_snapshot()
+        print(f"Catalogue snapshot: {len(CatalogueSnapshot(app.config['CATALOGUE_SNAPSHOT_PATH']))} products")
+        sys.exit(0)
+    
     print("Server starting on http://localhost:5000")
     print("=" * 50)
     
@@ -0,0 +1,307 @@
+import bisect
+import heapq
+import mmap
+import re
+import os
+import struct
+import tempfile
+from array import array
+from collections import Counter
+
+# Columnar, memory-mapped snapshot of the products catalogue used for matching.
+#
+# Every distinct string (display values and lower-cased lookup keys) is stored
+# once in a sorted string table, so a string code compares the same way as the
+# string itself. Rows are product ids plus string codes, inStock is a bitset and
+# the two match tiers are stored as sorted code arrays, so lookups are binary
+# searches over the mapped file and nothing is copied per worker. Fuzzy
+# candidates come from trigram postings over the name index, so they do not
+# depend on how a name starts.
+#
+# The file is written in host byte order and is meant to be read on the host
+# that built it.
+
+MAGIC = b'RCCAT\x00\x02\x00'
+HEADER = struct.Struct('=8sIIIIIII')
+NULL = 0xFFFFFFFF
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _key(value):
+    return str(value or '').strip().lower()
+
+
+def _trigrams(text):
+    # Trigrams of each alphanumeric token padded with spaces, packed into one int each,
+    # so "TAB DOLO 650" and "Dollo 650" still share most trigrams with "dolo 650"
+    grams = set()
+    for token in re.findall(r'[^\W_]+', text.lower()):
+        padded = f' {token} '
+        for i in range(len(padded) - 2):
+            grams.add((ord(padded[i]) << 42) | (ord(padded[i + 1]) << 21) | ord(padded[i + 2]))
+    return grams
+
+
+def _first_per_key(keys, rows, keep_last=False):
+    # Sorts (key, row) pairs by key and keeps one row per key: the first appended
+    # (lowest row), or the last appended when keep_last is set
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    out_keys = array(keys.typecode)
+    out_rows = array('I')
+    for i in order:
+        if out_keys and out_keys[-1] == keys[i]:
+            if keep_last:
+                out_rows[-1] = rows[i]
+            continue
+        out_keys.append(keys[i])
+        out_rows.append(rows[i])
+    return out_keys, out_rows
+
+
+def write_catalogue_snapshot(path, rows):
+    # rows is any iterable of dicts with product_id, name, composition,
+    # rc_pharam_product_name and inStock, e.g. an unbuffered SSDictCursor. Only
+    # the distinct strings and fixed-width columns are held while building.
+    #
+    # The two lookup tiers mirror find_stock_match: (name or RC name, composition)
+    # keeps the last row seen, name or RC name alone keeps the first.
+    interned = {}
+
+    def intern(value):
+        if value is None:
+            return NULL
+        return interned.setdefault(value, len(interned))
+
+    product_ids = array('q')
+    columns = {field: array('I') for field in ('name', 'composition', 'rc_pharam_product_name')}
+    in_stock = bytearray()
+    full_names, full_comps, full_rows = array('I'), array('I'), array('I')
+    name_keys, name_rows = array('I'), array('I')
+
+    for i, p in enumerate(rows):
+        product_ids.append(p['product_id'])
+        for field, column in columns.items():
+            column.append(intern(None if p[field] is None else str(p[field])))
+        if i % 8 == 0:
+            in_stock.append(0)
+        if p['inStock']:
+            in_stock[i >> 3] |= 1 << (i & 7)
+
+        name_lower = _key(p['name'])
+        rc_name_lower = _key(p['rc_pharam_product_name'])
+        comp_lower = _key(p['composition'])
+        for key in (name_lower, rc_name_lower):
+            if key:
+                name_keys.append(intern(key))
+                name_rows.append(i)
+                if comp_lower:
+                    full_names.append(intern(key))
+                    full_comps.append(intern(comp_lower))
+                    full_rows.append(i)
+
+    # Renumber strings in sorted order, so codes compare like the strings they stand for
+    table = list(interned)
+    table_order = sorted(range(len(table)), key=table.__getitem__)
+    final = array('I', bytes(4 * len(table)))
+    for code, provisional in enumerate(table_order):
+        final[provisional] = code
+    table = [table[provisional] for provisional in table_order]
+    del interned, table_order
+
+    for column in (*columns.values(), name_keys):
+        for i, code in enumerate(column):
+            if code != NULL:
+                column[i] = final[code]
+
+    full_keys = array('Q', ((final[name] << 32) | final[comp] for name, comp in zip(full_names, full_comps)))
+    del full_names, full_comps
+    full_keys, full_rows = _first_per_key(full_keys, full_rows, keep_last=True)
+    name_keys, name_rows = _first_per_key(name_keys, name_rows)
+
+    # Trigram postings: for each trigram, the name index entries containing it. Built as a
+    # counting sort over two passes so only the postings array itself is held.
+    trigram_ids = {}
+    counts = array('I')
+    for code in name_keys:
+        for gram in _trigrams(table[code]):
+            gram_id = trigram_ids.setdefault(gram, len(trigram_ids))
+            if gram_id == len(counts):
+                counts.append(0)
+            counts[gram_id] += 1
+
+    trigram_keys = array('Q', sorted(trigram_ids))
+    trigram_offsets = array('I', [0])
+    fill = array('I', bytes(4 * len(trigram_keys)))
+    for gram in trigram_keys:
+        fill[trigram_ids[gram]] = trigram_offsets[-1]
+        trigram_offsets.append(trigram_offsets[-1] + counts[trigram_ids[gram]])
+    del counts
+
+    postings = array('I', bytes(4 * trigram_offsets[-1]))
+    for entry, code in enumerate(name_keys):
+        for gram in _trigrams(table[code]):
+            gram_id = trigram_ids[gram]
+            postings[fill[gram_id]] = entry
+            fill[gram_id] += 1
+    del trigram_ids, fill
+
+    offsets = array('I', [0])
+    blob = bytearray()
+    for s in table:
+        blob += s.encode('utf-8')
+        offsets.append(len(blob))
+    n_strings = len(table)
+    del table
+
+    # Arrays are written through the buffer protocol, so no second copy is made
+    sections = [
+        product_ids,
+        columns['name'],
+        columns['composition'],
+        columns['rc_pharam_product_name'],
+        in_stock,
+        offsets,
+        blob,
+        full_keys,
+        full_rows,
+        name_keys,
+        name_rows,
+        trigram_keys,
+        trigram_offsets,
+        postings,
+    ]
+
+    # Write next to the target and rename, so readers only ever see a complete file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.catalogue-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(product_ids), n_strings, len(blob), len(full_keys), len(name_keys),
+                                len(trigram_keys), len(postings)))
+            for section in sections:
+                f.write(b'\x00' * (_align(f.tell()) - f.tell()))
+                f.write(section)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class _StringTable:
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, code):
+        return str(self._blob[self._offsets[code]:self._offsets[code + 1]], 'utf-8')
+
+    def find(self, value):
+        code = bisect.bisect_left(self, value)
+        if code < len(self) and self[code] == value:
+            return code
+        return None
+
+
+class _Index:
+    # dict-like .get() over a sorted key array, so find_stock_match works unchanged
+
+    def __init__(self, snapshot, keys, rows, encode):
+        self._snapshot = snapshot
+        self._keys = keys
+        self._rows = rows
+        self._encode = encode
+
+    def get(self, key, default=None):
+        encoded = self._encode(key)
+        if encoded is None:
+            return default
+        i = bisect.bisect_left(self._keys, encoded)
+        if i < len(self._keys) and self._keys[i] == encoded:
+            return self._snapshot.row(self._rows[i])
+        return default
+
+
+class CatalogueSnapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER.size:
+            raise ValueError(f'{path} is not a catalogue snapshot')
+        magic, n_rows, n_strings, blob_len, n_full, n_name, n_trigrams, n_postings = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a catalogue snapshot')
+
+        view = memoryview(self._mm)
+        offset = HEADER.size
+
+        def take(fmt, count):
+            nonlocal offset
+            offset = _align(offset)
+            size = count * array(fmt).itemsize
+            section = view[offset:offset + size]
+            offset += size
+            return section.cast(fmt) if fmt != 'B' else section
+
+        self.product_ids = take('q', n_rows)
+        self._name = take('I', n_rows)
+        self._composition = take('I', n_rows)
+        self._rc_name = take('I', n_rows)
+        self._in_stock = take('B', (n_rows + 7) // 8)
+        self.strings = _StringTable(take('I', n_strings + 1), take('B', blob_len))
+        full_keys = take('Q', n_full)
+        full_rows = take('I', n_full)
+        name_keys = take('I', n_name)
+        name_rows = take('I', n_name)
+        self._trigram_keys = take('Q', n_trigrams)
+        self._trigram_offsets = take('I', n_trigrams + 1)
+        self._postings = take('I', n_postings)
+
+        self.lookup_full = _Index(self, full_keys, full_rows, self._encode_full_key)
+        self.lookup_name_only = _Index(self, name_keys, name_rows, self.strings.find)
+        self._name_keys = name_keys
+        self._name_rows = name_rows
+
+    def _encode_full_key(self, key):
+        name_code = self.strings.find(key[0])
+        comp_code = self.strings.find(key[1])
+        if name_code is None or comp_code is None:
+            return None
+        return (name_code << 32) | comp_code
+
+    def _string(self, code):
+        return None if code == NULL else self.strings[code]
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def in_stock(self, i):
+        return bool(self._in_stock[i >> 3] & (1 << (i & 7)))
+
+    def row(self, i):
+        return {
+            'product_id': self.product_ids[i],
+            'name': self._string(self._name[i]),
+            'composition': self._string(self._composition[i]),
+            'rc_pharam_product_name': self._string(self._rc_name[i]),
+            'inStock': self.in_stock(i)
+        }
+
+    def fuzzy_candidates(self, text, limit):
+        # {row: lower-cased name} for the names and RC names sharing the most trigrams with
+        # text. Postings are read straight from the mapped file.
+        shared = Counter()
+        for gram in _trigrams(text):
+            i = bisect.bisect_left(self._trigram_keys, gram)
+            if i < len(self._trigram_keys) and self._trigram_keys[i] == gram:
+                shared.update(self._postings[self._trigram_offsets[i]:self._trigram_offsets[i + 1]])
+
+        best = heapq.nlargest(limit, shared.items(), key=lambda item: (item[1], -item[0]))
+        return {self._name_rows[entry]: self.strings[self._name_keys[entry]] for entry, _ in best}
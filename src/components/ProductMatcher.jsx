@@ -1,5 +1,4 @@
 import React, { useState, useCallback, useMemo, useRef } from 'react';
-import * as XLSX from 'xlsx';
 import { productAPI } from '../services/api';
 import './ProductMatcher.css';
 import { AgGridReact } from 'ag-grid-react';
@@ -15,6 +14,7 @@ const ProductMatcher = () => {
     const [matchSearchTerm, setMatchSearchTerm] = useState('');
     const [matchResults, setMatchResults] = useState([]);
     const [searchingMatches, setSearchingMatches] = useState(false);
+    const [fuzzySuggestions, setFuzzySuggestions] = useState(false);
     const gridRef = useRef();
 
     const columnDefs = useMemo(() => [
@@ -84,93 +84,87 @@ const ProductMatcher = () => {
         setFile(e.target.files[0]);
     };
 
+    const toRow = (event) => ({
+        id: event.id,
+        brand_name: event.product.brand_name,
+        generic_name: event.product.generic_name,
+        manufacturer: event.product.manufacturer,
+        packing: event.product.packing,
+        sheet_name: event.product.sheet_name,
+        matched_name: '',
+        matched_composition: '',
+        stock_status: '',
+        status: 'Pending',
+        details: '',
+        candidates: event.candidates || []
+    });
+
     const handleUpload = async () => {
         if (!file) return;
 
         setLoading(true);
-        const reader = new FileReader();
-        reader.onload = (e) => {
-            try {
-                const data = new Uint8Array(e.target.result);
-                const workbook = XLSX.read(data, { type: 'array' });
-
-                let allProducts = [];
-                let idCounter = 0;
-
-                workbook.SheetNames.forEach(sheetName => {
-                    const worksheet = workbook.Sheets[sheetName];
-                    const jsonData = XLSX.utils.sheet_to_json(worksheet);
-
-                    const sheetProducts = jsonData.map((row) => ({
-                        id: idCounter++,
-                        brand_name: row['BRAND NAME'] || row['Brand Name'] || '',
-                        generic_name: row['GENERIC NAME'] || row['Generic Name'] || '',
-                        manufacturer: row['MANUFACTURER'] || row['Manufacturer'] || '',
-                        packing: row['PACKING'] || row['Packing'] || '',
-                        sheet_name: sheetName,
-                        matched_name: '',
-                        matched_composition: '',
-                        stock_status: '',
-                        status: 'Pending',
-                        details: ''
-                    })).filter(p => p.brand_name);
-
-                    allProducts = [...allProducts, ...sheetProducts];
-                });
-
-                if (allProducts.length === 0) {
-                    alert('No valid products found in any sheet. Please check column headers.');
-                } else {
-                    setRowData(allProducts);
-                    // Automatically detect matches after loading data
-                    handleAutoDetectMatches(allProducts);
-                }
-                setLoading(false);
-            } catch (error) {
-                console.error('Error reading file:', error);
-                alert('Error reading file');
-                setLoading(false);
-            }
+        setProcessing(true);
+        setRowData([]);
+
+        const formData = new FormData();
+        formData.append('file', file);
+        formData.append('fuzzy', fuzzySuggestions ? 'true' : 'false');
+
+        // Rows arrive one event at a time; flush them to the grid in batches
+        let pending = [];
+        const flush = () => {
+            if (pending.length === 0) return;
+            const batch = pending;
+            pending = [];
+            setRowData(prevData => [...prevData, ...batch]);
         };
-        reader.readAsArrayBuffer(file);
-    };
 
-    const handleAutoDetectMatches = async (products) => {
         try {
-            setProcessing(true);
-            const response = await productAPI.matchStock(products);
-            if (response.success && response.matched_products) {
-                // Create a map for faster lookup
-                const matchMap = new Map();
-                response.matched_products.forEach(m => {
-                    const key = `${m.matched_brand.toLowerCase()}|${m.matched_generic.toLowerCase()}`;
-                    matchMap.set(key, m);
-                });
+            let total = 0;
+            await productAPI.uploadAndMatch(formData, (event) => {
+                switch (event.type) {
+                    case 'start':
+                        total = event.count;
+                        break;
+                    case 'matched': {
+                        const match = event.match;
+                        pending.push({
+                            ...toRow(event),
+                            status: 'Matched',
+                            details: `Auto-Detected: ${match.rc_pharam_product_name || '(No RC Name)'}`,
+                            matched_name: match.rc_pharam_product_name || match.name,
+                            matched_composition: match.composition,
+                            stock_status: match.inStock ? 'In Stock' : 'Out of Stock',
+                            product_id: match.product_id
+                        });
+                        break;
+                    }
+                    case 'unmatched': {
+                        const best = event.candidates && event.candidates[0];
+                        pending.push({
+                            ...toRow(event),
+                            details: best ? `Suggestion: ${best.rc_pharam_product_name || best.name} (${best.match_score}%)` : ''
+                        });
+                        break;
+                    }
+                    case 'error':
+                        throw new Error(event.error);
+                    default:
+                        break;
+                }
+                if (pending.length >= 200) flush();
+            });
+            flush();
 
-                // Update rowData state directly
-                setRowData(prevData => {
-                    return prevData.map(row => {
-                        const rowKey = `${row.brand_name.toLowerCase()}|${row.generic_name.toLowerCase()}`;
-                        const match = matchMap.get(rowKey);
-
-                        if (match) {
-                            return {
-                                ...row,
-                                status: 'Matched',
-                                details: `Auto-Detected: ${match.rc_pharam_product_name || '(No RC Name)'}`,
-                                matched_name: match.rc_pharam_product_name || match.name,
-                                matched_composition: match.composition,
-                                stock_status: match.inStock ? 'In Stock' : 'Out of Stock',
-                                product_id: match.product_id
-                            };
-                        }
-                        return row;
-                    });
-                });
+            if (total === 0) {
+                alert('No valid products found in any sheet. Please check column headers.');
             }
         } catch (error) {
-            console.error('Auto-detection failed:', error);
+            flush();
+            console.error('Error uploading file:', error);
+            alert('Error uploading file: ' + error.message);
         } finally {
+            setLoading(false);
             setProcessing(false);
         }
     };
@@ -179,16 +173,22 @@ const ProductMatcher = () => {
     const handleOpenMatchModal = (product) => {
         setSelectedProduct(product);
         setMatchSearchTerm(product.brand_name);
-        setMatchResults([]);
-        handleSearchMatches(product.brand_name, product.generic_name, product.brand_name);
+        setMatchResults(product.candidates || []);
+        handleSearchMatches(product.brand_name, product.generic_name, product.brand_name, product.candidates);
     };
 
-    const handleSearchMatches = async (term, generic, excelBrand) => {
+    // Fuzzy suggestions from the upload stay at the top; search results fill in the rest
+    const mergeMatchResults = (candidates, results) => {
+        const seen = new Set(candidates.map(c => c.product_id));
+        return [...candidates, ...results.filter(r => !seen.has(r.product_id))];
+    };
+
+    const handleSearchMatches = async (term, generic, excelBrand, candidates = []) => {
         setSearchingMatches(true);
         try {
             const response = await productAPI.findMatches(term, generic, excelBrand);
             if (response.success) {
-                setMatchResults(response.data);
+                setMatchResults(mergeMatchResults(candidates, response.data));
             }
         } catch (error) {
             console.error('Match search failed:', error);
@@ -311,6 +311,15 @@ const ProductMatcher = () => {
                         {file ? `📄 ${file.name}` : '📁 Select Excel File'}
                     </label>
 
+                    <label className="fuzzy-toggle">
+                        <input
+                            type="checkbox"
+                            checked={fuzzySuggestions}
+                            onChange={(e) => setFuzzySuggestions(e.target.checked)}
+                        />
+                        Suggest fuzzy matches (slower)
+                    </label>
+
                     <button
                         onClick={handleUpload}
                         disabled={!file || loading}
@@ -362,11 +371,11 @@ const ProductMatcher = () => {
                                     value={matchSearchTerm}
                                     onChange={(e) => setMatchSearchTerm(e.target.value)}
                                     placeholder="Search RC Product Name..."
-                                    onKeyPress={(e) => e.key === 'Enter' && handleSearchMatches(matchSearchTerm, selectedProduct.generic_name, selectedProduct.brand_name)}
+                                    onKeyPress={(e) => e.key === 'Enter' && handleSearchMatches(matchSearchTerm, selectedProduct.generic_name, selectedProduct.brand_name, selectedProduct.candidates)}
                                 />
                                 <button
                                     className="btn-search"
-                                    onClick={() => handleSearchMatches(matchSearchTerm, selectedProduct.generic_name, selectedProduct.brand_name)}
+                                    onClick={() => handleSearchMatches(matchSearchTerm, selectedProduct.generic_name, selectedProduct.brand_name, selectedProduct.candidates)}
                                     disabled={searchingMatches}
                                 >
                                     {searchingMatches ? 'Searching...' : 'Search'}
@@ -56,6 +56,37 @@ export const productAPI = {
         return response.data;
     },
 
+    // Streams newline-delimited JSON events (start / matched / unmatched / done / error) to onEvent
+    uploadAndMatch: async (formData, onEvent) => {
+        const response = await fetch(`${API_BASE_URL}/products/upload-and-match`, {
+            method: 'POST',
+            body: formData,
+        });
+
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({}));
+            throw new Error(error.error || `Upload failed with status ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.filter(line => line.trim()).forEach(line => onEvent(JSON.parse(line)));
+        }
+
+        if (buffer.trim()) {
+            onEvent(JSON.parse(buffer));
+        }
+    },
+
     findMatches: async (productName, genericName = '', excelBrandName = '') => {
         const response = await api.post('/products/find-matches', {
             product_name: productName,
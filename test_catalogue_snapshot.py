@@ -0,0 +1,117 @@
+import pytest
+
+from catalogue_snapshot import MAGIC, CatalogueSnapshot, write_catalogue_snapshot
+
+
+def build_dict_lookups(db_all):
+    # The in-memory lookups match_stock built from DictCursor rows before the snapshot
+    lookup_full = {}
+    lookup_name_only = {}
+
+    for p in db_all:
+        name_lower = str(p['name'] or '').strip().lower()
+        rc_name_lower = str(p['rc_pharam_product_name'] or '').strip().lower()
+        comp_lower = str(p['composition'] or '').strip().lower()
+
+        if comp_lower:
+            if name_lower: lookup_full[(name_lower, comp_lower)] = p
+            if rc_name_lower: lookup_full[(rc_name_lower, comp_lower)] = p
+
+        if name_lower and name_lower not in lookup_name_only:
+            lookup_name_only[name_lower] = p
+        if rc_name_lower and rc_name_lower not in lookup_name_only:
+            lookup_name_only[rc_name_lower] = p
+
+    return lookup_full, lookup_name_only
+
+
+def product(product_id, name, composition=None, rc_name=None, in_stock=False):
+    return {
+        'product_id': product_id,
+        'name': name,
+        'composition': composition,
+        'rc_pharam_product_name': rc_name,
+        'inStock': in_stock
+    }
+
+
+ROWS = [
+    product(11, 'Dolo 650', 'Paracetamol 650', None, True),
+    product(12, 'DOLO 650 ', 'paracetamol 650', 'Dolo Tab', False),
+    product(13, 'Crocin', 'Paracetamol 500', 'dolo 650', True),
+    product(14, 'Azee 500', None, 'Azithral', False),
+    product(15, None, 'Azithromycin', 'Azee 500', True),
+    product(16, '', '', '', None),
+    product(17, 'Pan 40', 'Pantoprazole', 'PAN 40', 1),
+    product(18, 'Ülta', 'Ursodiol', None, 0),
+    product(19, 'Pan 40', 'Pantoprazole', None, 0),
+]
+
+
+def expected(p):
+    return None if p is None else {**p, 'inStock': bool(p['inStock'])}
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    path = tmp_path / 'catalogue.snapshot'
+    write_catalogue_snapshot(str(path), iter(ROWS))
+    return CatalogueSnapshot(str(path))
+
+
+def test_lookups_match_dict_tiers(snapshot):
+    lookup_full, lookup_name_only = build_dict_lookups(ROWS)
+
+    for key, p in lookup_full.items():
+        assert snapshot.lookup_full.get(key) == expected(p)
+    for key, p in lookup_name_only.items():
+        assert snapshot.lookup_name_only.get(key) == expected(p)
+
+    # (name, composition) keeps the last row, name alone keeps the first
+    assert snapshot.lookup_full.get(('pan 40', 'pantoprazole'))['product_id'] == 19
+    assert snapshot.lookup_name_only.get('pan 40')['product_id'] == 17
+    assert snapshot.lookup_name_only.get('dolo 650')['product_id'] == 11
+
+    assert snapshot.lookup_full.get(('dolo 650', 'missing')) is None
+    assert snapshot.lookup_name_only.get('missing') is None
+    assert snapshot.lookup_name_only.get('') is None
+
+
+def test_rows_and_in_stock_bits(snapshot):
+    assert len(snapshot) == len(ROWS)
+    for i, p in enumerate(ROWS):
+        assert snapshot.row(i) == expected(p)
+        assert snapshot.in_stock(i) is bool(p['inStock'])
+
+
+def test_empty_catalogue(tmp_path):
+    path = tmp_path / 'catalogue.snapshot'
+    write_catalogue_snapshot(str(path), [])
+    snapshot = CatalogueSnapshot(str(path))
+
+    assert len(snapshot) == 0
+    assert snapshot.lookup_name_only.get('dolo 650') is None
+    assert snapshot.lookup_full.get(('dolo 650', 'paracetamol 650')) is None
+    assert snapshot.fuzzy_candidates('Dolo 650', 10) == {}
+
+
+def test_rejects_other_format_versions(tmp_path):
+    path = tmp_path / 'catalogue.snapshot'
+    write_catalogue_snapshot(str(path), ROWS)
+    data = path.read_bytes()
+
+    path.write_bytes(MAGIC[:-2] + b'\x01\x00' + data[len(MAGIC):])
+    with pytest.raises(ValueError):
+        CatalogueSnapshot(str(path))
+
+    path.write_bytes(data[:4])
+    with pytest.raises(ValueError):
+        CatalogueSnapshot(str(path))
+
+
+def test_fuzzy_candidates_ignore_leading_words_and_typos(snapshot):
+    for text in ('TAB DOLO 650', 'Dollo 650', 'dolo'):
+        names = snapshot.fuzzy_candidates(text, 3).values()
+        assert 'dolo 650' in names
+
+    assert snapshot.fuzzy_candidates('', 3) == {}